@@ -6,17 +6,23 @@ from __future__ import annotations
 # Note: import as little as possible here at the module level to
 # keep launch times fast for small snippets.
 import sys
+from typing import TYPE_CHECKING
 
 from efrotools import pcommand
 
+if TYPE_CHECKING:
+    from os import DirEntry
+
 
 def gen_monolithic_register_modules() -> None:
     """Generate .h file for registering py modules."""
+    # pylint: disable=too-many-locals
     import os
-    import textwrap
+    import json
+    from pathlib import Path
 
     from efro.error import CleanError
-    from batools.featureset import FeatureSet
+    from efrotools.util import get_files_hash
 
     pcommand.disallow_in_batch()
 
@@ -24,12 +30,38 @@ def gen_monolithic_register_modules() -> None:
         raise CleanError('Expected 1 arg.')
     outpath = sys.argv[2]
 
-    featuresets = FeatureSet.get_all_for_project(str(pcommand.PROJROOT))
+    # Loading all featuresets is the expensive part of this, and the
+    # module names we need only change when featureset defs (or the
+    # featureset logic deriving names from them) do. So we cache the
+    # names keyed by a hash of those files.
+    fsdir = Path(pcommand.PROJROOT, 'config/featuresets')
+    fsfiles = sorted(str(p) for p in fsdir.glob('*.py')) + [
+        str(Path(pcommand.PROJROOT, 'tools/batools/featureset.py'))
+    ]
+    fshash = get_files_hash(fsfiles, extrahash=','.join(fsfiles))
+    cachepath = Path(pcommand.PROJROOT, '.cache/monolithic_py_modules')
+    pymodulenames: list[str] | None = None
+    try:
+        cache = json.loads(cachepath.read_bytes())
+        if cache['hash'] == fshash:
+            pymodulenames = cache['modules']
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        pass
 
-    # Filter out ones without native modules.
-    featuresets = [f for f in featuresets if f.has_python_binary_module]
+    if pymodulenames is None:
+        from batools.featureset import FeatureSet
 
-    pymodulenames = sorted(f.name_python_binary_module for f in featuresets)
+        featuresets = FeatureSet.get_all_for_project(str(pcommand.PROJROOT))
+
+        # Filter out ones without native modules.
+        featuresets = [f for f in featuresets if f.has_python_binary_module]
+
+        pymodulenames = sorted(f.name_python_binary_module for f in featuresets)
+        cachepath.parent.mkdir(parents=True, exist_ok=True)
+        cachepath.write_text(
+            json.dumps({'hash': fshash, 'modules': pymodulenames}),
+            encoding='utf-8',
+        )
 
     def initname(mname: str) -> str:
         # plus is a special case since we need to define that symbol
@@ -37,11 +69,15 @@ def gen_monolithic_register_modules() -> None:
         return f'DoPyInit_{mname}' if mname == '_baplus' else f'PyInit_{mname}'
 
     extern_def_code = '\n'.join(
-        f'auto {initname(n)}() -> PyObject*;' for n in pymodulenames
+        [f'auto {initname(n)}() -> PyObject*;' for n in pymodulenames]
     )
 
+    # (pre-indented to sit inside our register function)
     py_register_code = '\n'.join(
-        f'PyImport_AppendInittab("{n}", &{initname(n)});' for n in pymodulenames
+        [
+            f'    PyImport_AppendInittab("{n}", &{initname(n)});'
+            for n in pymodulenames
+        ]
     )
 
     if '_baplus' in pymodulenames:
@@ -69,55 +105,68 @@ def gen_monolithic_register_modules() -> None:
     else:
         init_plus_code = ''
 
-    base_code = """
-        // Released under the MIT License. See LICENSE for details.
-
-        #ifndef BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
-        #define BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
-
-        // THIS CODE IS AUTOGENERATED BY META BUILD; DO NOT EDIT BY HAND.
-
-        #include "ballistica/shared/ballistica.h"
-        #include "ballistica/shared/python/python_sys.h"
-
-        extern "C" {
-        ${EXTERN_DEF_CODE}
-        }
-
-        namespace ballistica {
-
-        /// Register init calls for all of our built-in Python modules.
-        /// Should only be used in monolithic builds. In modular builds
-        /// binary modules get located as .so files on disk as per regular
-        /// Python behavior.
-        void MonolithicRegisterPythonModules() {
-          if (g_buildconfig.monolithic_build()) {
-        ${PY_REGISTER_CODE}
-          } else {
-            FatalError(
-                "MonolithicRegisterPythonModules should not be called"
-                " in modular builds.");
-          }
-        }
-        ${PY_INIT_PLUS}
-        }  // namespace ballistica
-
-        #endif  // BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
-        """
-    out = (
-        textwrap.dedent(base_code)
-        .replace('${EXTERN_DEF_CODE}', extern_def_code)
-        .replace(
-            '${PY_REGISTER_CODE}', textwrap.indent(py_register_code, '    ')
-        )
-        .replace('${PY_INIT_PLUS}', init_plus_code)
-        .strip()
-        + '\n'
+    # Assemble everything in one go around our generated bits.
+    out = ''.join(
+        [
+            '// Released under the MIT License. See LICENSE for details.\n'
+            '\n'
+            '#ifndef BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_\n'
+            '#define BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_\n'
+            '\n'
+            '// THIS CODE IS AUTOGENERATED BY META BUILD;'
+            ' DO NOT EDIT BY HAND.\n'
+            '\n'
+            '#include "ballistica/shared/ballistica.h"\n'
+            '#include "ballistica/shared/python/python_sys.h"\n'
+            '\n'
+            'extern "C" {\n',
+            extern_def_code,
+            '\n'
+            '}\n'
+            '\n'
+            'namespace ballistica {\n'
+            '\n'
+            '/// Register init calls for all of our built-in Python modules.\n'
+            '/// Should only be used in monolithic builds. In modular builds\n'
+            '/// binary modules get located as .so files on disk as per'
+            ' regular\n'
+            '/// Python behavior.\n'
+            'void MonolithicRegisterPythonModules() {\n'
+            '  if (g_buildconfig.monolithic_build()) {\n',
+            py_register_code,
+            '\n'
+            '  } else {\n'
+            '    FatalError(\n'
+            '        "MonolithicRegisterPythonModules should not be called"\n'
+            '        " in modular builds.");\n'
+            '  }\n'
+            '}\n',
+            init_plus_code,
+            '\n'
+            '}  // namespace ballistica\n'
+            '\n'
+            '#endif  // BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_\n',
+        ]
     )
 
+    # If the file already has exactly this content, leave it untouched.
+    # Bumping its mtime would otherwise trigger recompiles of everything
+    # including it. (Make may re-run us in that case but we're cheap
+    # compared to a pile of C++ compiles).
+    outbytes = out.encode()
+    try:
+        existing = Path(outpath).read_bytes()
+    except FileNotFoundError:
+        existing = None
+    if existing == outbytes:
+        return
+
+    # Write to a temp file and move it into place so we never leave a
+    # partially written header around.
     os.makedirs(os.path.dirname(outpath), exist_ok=True)
-    with open(outpath, 'w', encoding='utf-8') as outfile:
-        outfile.write(out)
+    tmppath = f'{outpath}.tmp'
+    Path(tmppath).write_bytes(outbytes)
+    os.replace(tmppath, outpath)
 
 
 def py_examine() -> None:
@@ -160,45 +209,119 @@ def py_examine() -> None:
 
 def clean_orphaned_assets() -> None:
     """Remove asset files that are no longer part of the build."""
+    # pylint: disable=too-many-locals
     import os
     import json
-    import subprocess
+    from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Note: this is batch-friendly; we don't chdir and we only print
+    # via clientprint() from this thread.
+    srcdir = Path(pcommand.PROJROOT, 'src/assets')
+    builddir = Path(pcommand.PROJROOT, 'build/assets')
+
+    # Our manifest is split into 2 files (public and private). Parse
+    # straight from bytes and feed each list directly into our set.
+    manifest: set[str] = set()
+    for manifestpath in (
+        Path(srcdir, '.asset_manifest_public.json'),
+        Path(srcdir, '.asset_manifest_private.json'),
+    ):
+        manifest.update(json.loads(manifestpath.read_bytes()))
+
+    # Also gather every dir containing manifest entries; any dir not in
+    # this set is orphaned as a whole and can be dropped without looking
+    # at its individual files.
+    manifest_dirs: set[str] = set()
+    for fpath in manifest:
+        idx = fpath.rfind('/')
+        while idx != -1:
+            dirpath = fpath[:idx]
+            if dirpath in manifest_dirs:
+                break  # Parents will already be in there too.
+            manifest_dirs.add(dirpath)
+            idx = fpath.rfind('/', 0, idx)
+
+    # Prune orphaned files and any dirs left empty in a single pass.
+    # Top level entries are independent of each other so we spread them
+    # across threads; scandir/unlink/etc. release the GIL so this helps
+    # a fair bit on big trees.
+    try:
+        entries = os.scandir(builddir)
+    except FileNotFoundError:
+        return  # No assets built yet; nothing to do.
+    removed: list[str] = []
+    with entries, ThreadPoolExecutor(
+        max_workers=(os.cpu_count() or 1) * 2
+    ) as executor:
+        survivors = list(
+            executor.map(
+                lambda e: _clean_orphaned_asset_entry(
+                    e, '', manifest, manifest_dirs, removed
+                ),
+                entries,
+            )
+        )
+    if not any(survivors):
+        os.rmdir(builddir)
 
-    pcommand.disallow_in_batch()
+    for msg in sorted(removed):
+        pcommand.clientprint(msg)
 
-    # Operate from dist root..
-    os.chdir(pcommand.PROJROOT)
 
-    # Our manifest is split into 2 files (public and private)
-    with open(
-        'src/assets/.asset_manifest_public.json', encoding='utf-8'
-    ) as infile:
-        manifest = set(json.loads(infile.read()))
-    with open(
-        'src/assets/.asset_manifest_private.json', encoding='utf-8'
-    ) as infile:
-        manifest.update(set(json.loads(infile.read())))
-    for root, _dirs, fnames in os.walk('build/assets'):
-        for fname in fnames:
-            fpath = os.path.join(root, fname)
-            fpathrel = fpath[13:]  # paths are relative to build/assets
-            if fpathrel not in manifest:
-                print(f'Removing orphaned asset file: {fpath}')
-                os.unlink(fpath)
-
-    # Lastly, clear empty dirs.
-    subprocess.run(
-        'find build/assets -depth -empty -type d -delete',
-        shell=True,
-        check=True,
-    )
+def _clean_orphaned_asset_entry(
+    entry: DirEntry[str],
+    rel: str,
+    manifest: set[str],
+    manifest_dirs: set[str],
+    removed: list[str],
+) -> bool:
+    """Prune an orphaned asset file or dir (recursively).
+
+    Adds a message to the provided list for each removal (we may be
+    running in a worker thread where we can't clientprint()). Returns
+    whether anything remains of the entry afterwards.
+    """
+    import os
+    import shutil
+
+    entryrel = rel + entry.name
+    if entry.is_dir(follow_symlinks=False):
+        if entryrel not in manifest_dirs:
+            removed.append(
+                f'Removing orphaned asset dir: build/assets/{entryrel}'
+            )
+            shutil.rmtree(entry.path)
+            return False
+        survivors = False
+        with os.scandir(entry.path) as entries:
+            for subentry in entries:
+                if _clean_orphaned_asset_entry(
+                    subentry, entryrel + '/', manifest, manifest_dirs, removed
+                ):
+                    survivors = True
+        if not survivors:
+            os.rmdir(entry.path)
+        return survivors
+
+    if entryrel in manifest:
+        return True
+    removed.append(f'Removing orphaned asset file: build/assets/{entryrel}')
+    os.unlink(entry.path)
+    return False
 
 
 def win_ci_install_prereqs() -> None:
     """Install bits needed for basic win ci."""
+    # pylint: disable=too-many-locals
+    import os
+    import re
     import json
+    import hashlib
+    from pathlib import Path
+    from itertools import chain
 
-    from efrotools.efrocache import get_target
+    from efrotools.efrocache import get_targets
 
     pcommand.disallow_in_batch()
 
@@ -214,24 +337,53 @@ def win_ci_install_prereqs() -> None:
     }
 
     # Look through everything that gets generated by our meta builds
-    # and pick out anything we need for our basic builds/tests.
-    with open(
-        'src/meta/.meta_manifest_public.json', encoding='utf-8'
-    ) as infile:
-        meta_public: list[str] = json.loads(infile.read())
-    with open(
-        'src/meta/.meta_manifest_private.json', encoding='utf-8'
-    ) as infile:
-        meta_private: list[str] = json.loads(infile.read())
-    for target in meta_public + meta_private:
-        if (target.startswith('src/ballistica/') and '/mgen/' in target) or (
-            target.startswith('src/assets/ba_data/python/')
-            and '/_mgen/' in target
-        ):
-            needed_targets.add(target)
+    # and pick out anything we need for our basic builds/tests. The
+    # filtered list only changes when the manifests do, so we cache it
+    # keyed by a hash of the manifest contents and skip parsing
+    # entirely on a hit.
+    manifest_data = [
+        Path('src/meta/.meta_manifest_public.json').read_bytes(),
+        Path('src/meta/.meta_manifest_private.json').read_bytes(),
+    ]
+    hasher = hashlib.blake2b()
+    for data in manifest_data:
+        hasher.update(len(data).to_bytes(8, 'little'))
+        hasher.update(data)
+    cachekey = hasher.hexdigest()
+    cachepath = Path('.cache/win_ci_prereqs')
+    meta_targets: list[str] | None = None
+    try:
+        cache = json.loads(cachepath.read_bytes())
+        if cache['hash'] == cachekey:
+            meta_targets = cache['targets']
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        pass
+
+    if meta_targets is None:
+        # We want anything under an 'mgen' dir in our C++ sources or a
+        # '_mgen' dir in our Python ones.
+        match = re.compile(
+            r'src/ballistica/(?:.*/)?mgen/'
+            r'|src/assets/ba_data/python/(?:.*/)?_mgen/',
+            re.DOTALL,
+        ).match
+        meta_targets = [
+            target
+            for target in chain.from_iterable(
+                json.loads(data) for data in manifest_data
+            )
+            if match(target)
+        ]
+        cachepath.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = Path(f'{cachepath}.tmp')
+        tmppath.write_text(
+            json.dumps({'hash': cachekey, 'targets': meta_targets}),
+            encoding='utf-8',
+        )
+        os.replace(tmppath, cachepath)
+    needed_targets.update(meta_targets)
 
-    for target in needed_targets:
-        get_target(target, batch=pcommand.is_batch(), clr=pcommand.clr())
+    get_targets(needed_targets, batch=pcommand.is_batch(), clr=pcommand.clr())
 
 
 def win_ci_binary_build() -> None:
@@ -257,9 +409,12 @@ def win_ci_binary_build() -> None:
 
 def update_cmake_prefab_lib() -> None:
     """Update prefab internal libs; run as part of a build."""
+    # pylint: disable=too-many-locals
     import subprocess
     import os
+    import shutil
     from efro.error import CleanError
+    from efrotools.util import get_files_hash
     from batools.build import PrefabPlatform
 
     pcommand.disallow_in_batch()
@@ -286,29 +441,54 @@ def update_cmake_prefab_lib() -> None:
     )
 
     # Build the target and then copy it to dst if it doesn't exist there
-    # yet or the existing one is older than our target.
+    # yet or its contents differ from our target. We go by content and
+    # not mtime since things like git checkouts bump mtimes without
+    # changing anything and we don't want to trigger needless relinks.
     subprocess.run(['make', target], check=True)
 
     libdir = os.path.join(builddir, 'prefablib')
     libpath = os.path.join(libdir, 'libballisticaplus.a')
 
-    update = True
-    time1 = os.path.getmtime(target)
+    # We store the hash of whatever we last copied alongside it so we
+    # don't have to rehash the dst lib each time.
+    hashpath = f'{libpath}.sha256'
+
+    targethash = get_files_hash([target], hashtype='sha256')
+    existinghash: str | None = None
     if os.path.exists(libpath):
-        time2 = os.path.getmtime(libpath)
-        if time1 <= time2:
-            update = False
+        if os.path.exists(hashpath):
+            with open(hashpath, encoding='utf-8') as infile:
+                existinghash = infile.read()
+        else:
+            existinghash = get_files_hash([libpath], hashtype='sha256')
 
-    if update:
+    if targethash != existinghash:
         if not os.path.exists(libdir):
             os.makedirs(libdir, exist_ok=True)
-        subprocess.run(['cp', target, libdir], check=True)
+
+        # Kill any existing hash first; if the copy gets interrupted we
+        # don't want a stale hash vouching for a partial lib.
+        if os.path.exists(hashpath):
+            os.unlink(hashpath)
+
+        # Note: we intentionally give the copy a fresh mtime (as cp
+        # did) so anything linking against it sees it as changed.
+        shutil.copyfile(target, libpath)
+
+    # Only record the hash once the lib in place is known to match it.
+    if targethash != existinghash or not os.path.exists(hashpath):
+        with open(hashpath, 'w', encoding='utf-8') as outfile:
+            outfile.write(targethash)
 
 
 def android_archive_unstripped_libs() -> None:
     """Copy libs to a build archive."""
-    import subprocess
+    # pylint: disable=too-many-locals
+    import os
+    import shutil
+    import tarfile
     from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor
     from efro.error import CleanError
     from efro.terminal import Clr
 
@@ -319,28 +499,44 @@ def android_archive_unstripped_libs() -> None:
     src = Path(sys.argv[2])
     dst = Path(sys.argv[3])
     if dst.exists():
-        subprocess.run(['rm', '-rf', dst], check=True)
+        shutil.rmtree(dst)
     dst.mkdir(parents=True, exist_ok=True)
     if not src.is_dir():
         raise CleanError(f"Source dir not found: '{src}'")
     libname = 'libmain'
     libext = '.so'
-    for abi, abishort in [
-        ('armeabi-v7a', 'arm'),
-        ('arm64-v8a', 'arm64'),
-        ('x86', 'x86'),
-        ('x86_64', 'x86-64'),
-    ]:
-        srcpath = Path(src, abi, libname + libext)
-        dstname = f'{libname}_{abishort}{libext}'
+
+    def _archive(srcpath: Path, dstname: str) -> None:
         dstpath = Path(dst, dstname)
-        if srcpath.exists():
-            print(f'Archiving unstripped library: {Clr.BLD}{dstname}{Clr.RST}')
-            subprocess.run(['cp', srcpath, dstpath], check=True)
-            subprocess.run(
-                ['tar', '-zcf', dstname + '.tgz', dstname], cwd=dst, check=True
-            )
-            subprocess.run(['rm', dstpath], check=True)
+        shutil.copyfile(srcpath, dstpath)
+        with tarfile.open(
+            Path(dst, dstname + '.tgz'), 'w:gz', compresslevel=1
+        ) as outfile:
+            outfile.add(dstpath, arcname=dstname)
+        os.unlink(dstpath)
+
+    # Compression dominates here and zlib releases the GIL, so we can
+    # archive all abis in parallel.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = []
+        for abi, abishort in [
+            ('armeabi-v7a', 'arm'),
+            ('arm64-v8a', 'arm64'),
+            ('x86', 'x86'),
+            ('x86_64', 'x86-64'),
+        ]:
+            srcpath = Path(src, abi, libname + libext)
+            dstname = f'{libname}_{abishort}{libext}'
+            if srcpath.exists():
+                print(
+                    f'Archiving unstripped library:'
+                    f' {Clr.BLD}{dstname}{Clr.RST}'
+                )
+                futures.append(executor.submit(_archive, srcpath, dstname))
+
+        # Pull results to propagate any errors.
+        for future in futures:
+            future.result()
 
 
 def spinoff_test() -> None:
@@ -353,20 +549,36 @@ def spinoff_test() -> None:
 def spinoff_check_submodule_parent() -> None:
     """Make sure this dst proj has a submodule parent."""
     import os
-    from efro.error import CleanError
+    import stat
 
     pcommand.disallow_in_batch()
 
+    # Note: we stat things directly instead of going through os.path
+    # calls (one syscall per check instead of several) and only pull in
+    # CleanError when we're actually failing.
+
     # Make sure we're a spinoff dst project. The spinoff command will be
     # a symlink if this is the case.
-    if not os.path.exists('tools/spinoff'):
+    try:
+        spinoff_mode = os.lstat('tools/spinoff').st_mode
+    except OSError:
+        from efro.error import CleanError
+
         raise CleanError(
             'This does not appear to be a spinoff-enabled project.'
-        )
-    if not os.path.islink('tools/spinoff'):
+        ) from None
+    if not stat.S_ISLNK(spinoff_mode):
+        from efro.error import CleanError
+
         raise CleanError('This project is a spinoff parent; we require a dst.')
 
-    if not os.path.isdir('submodules/ballistica'):
+    try:
+        parent_is_dir = stat.S_ISDIR(os.stat('submodules/ballistica').st_mode)
+    except OSError:
+        parent_is_dir = False
+    if not parent_is_dir:
+        from efro.error import CleanError
+
         raise CleanError(
             'This project is not using a submodule for its parent.\n'
             'To set one up, run `tools/spinoff add-submodule-parent`'
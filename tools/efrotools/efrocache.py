@@ -30,6 +30,8 @@ from efro.terminal import Clr
 
 
 if TYPE_CHECKING:
+    from typing import Iterable
+
     import efro.terminal
 
 
@@ -91,10 +93,9 @@ def get_existing_file_hash(path: str) -> str:
     """Return the hash used for caching."""
     import hashlib
 
-    prefix = _cache_prefix_for_file(path)
-    md5 = hashlib.md5()
+    md5 = hashlib.md5(_cache_prefix_for_file(path))
     with open(path, 'rb') as infile:
-        md5.update(prefix + infile.read())
+        hashlib.file_digest(infile, lambda: md5)
     return md5.hexdigest()
 
 
@@ -115,21 +116,96 @@ def _project_centric_path(path: str) -> str:
 
 def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
     """Fetch a target path from the cache, downloading if need be."""
+    with open(CACHE_MAP_NAME, encoding='utf-8') as infile:
+        efrocachemap = json.loads(infile.read())
+    return _get_target(
+        path,
+        efrocachemap=efrocachemap,
+        repo=get_repository_base_url(),
+        local_cache_dir=get_local_cache_dir(),
+        batch=batch,
+        clr=clr,
+    )
+
+
+def get_targets(
+    paths: Iterable[str], batch: bool, clr: type[efro.terminal.ClrBase]
+) -> str:
+    """Fetch a set of target paths from the cache.
+
+    This is more efficient than calling get_target() for each path; the
+    cache map and project config are only loaded once and downloads run
+    in parallel.
+    """
+    with open(CACHE_MAP_NAME, encoding='utf-8') as infile:
+        efrocachemap = json.loads(infile.read())
+    repo = get_repository_base_url()
+    local_cache_dir = get_local_cache_dir()
+
+    # Targets with identical contents share a local cache file, so we
+    # group them by hash and handle each group in a single worker; that
+    # way we never have multiple threads downloading/reading the same
+    # cache file at once.
+    groups: dict[str, list[str]] = {}
+    for path in sorted(set(paths)):
+        # (unknown paths get their own group; they'll error in the fetch)
+        hashval = efrocachemap.get(_project_centric_path(path), path)
+        groups.setdefault(hashval, []).append(path)
+
+    def _get(group: list[str]) -> str:
+        # Always capture output here so lines from different fetches
+        # don't get interleaved; we print them in order below if need be.
+        return '\n'.join(
+            output
+            for output in (
+                _get_target(
+                    path,
+                    efrocachemap=efrocachemap,
+                    repo=repo,
+                    local_cache_dir=local_cache_dir,
+                    batch=True,
+                    clr=clr,
+                )
+                for path in group
+            )
+            if output
+        )
+
+    # Downloads are mostly waiting on the network so we can run a fair
+    # number at once.
+    output_lines: list[str] = []
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for output in executor.map(_get, groups.values()):
+            if not output:
+                continue
+            if batch:
+                output_lines.append(output)
+            else:
+                print(output)
+
+    return '\n'.join(output_lines)
+
+
+def _get_target(
+    path: str,
+    efrocachemap: dict[str, str],
+    repo: str,
+    local_cache_dir: str,
+    batch: bool,
+    clr: type[efro.terminal.ClrBase],
+) -> str:
     # pylint: disable=too-many-locals
     # pylint: disable=too-many-statements
     # pylint: disable=too-many-branches
+    import shutil
     import tempfile
 
     from efro.error import CleanError
 
     output_lines: list[str] = []
 
-    local_cache_dir = get_local_cache_dir()
-
     path = _project_centric_path(path)
 
-    with open(CACHE_MAP_NAME, encoding='utf-8') as infile:
-        efrocachemap = json.loads(infile.read())
     if path not in efrocachemap:
         raise RuntimeError(f'Path not found in efrocache: {path}')
 
@@ -142,7 +218,6 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
     # If our hash is 'abcdefghijkl', our subpath is 'ab/cd/efghijkl'.
     subpath = '/'.join([hashval[:2], hashval[2:4], hashval[4:]])
 
-    repo = get_repository_base_url()
     url = f'{repo}/{subpath}'
 
     local_cache_path = os.path.join(local_cache_dir, subpath)
@@ -208,9 +283,7 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
             # Ok; cache download finished. Lastly move it in place to be as
             # atomic as possible.
             os.makedirs(os.path.dirname(local_cache_path), exist_ok=True)
-            subprocess.run(
-                ['mv', local_cache_dl_path, local_cache_path], check=True
-            )
+            shutil.move(local_cache_dl_path, local_cache_path)
 
     # Ok we should have a valid file in our cache dir at this point.
     # Just expand it to the target path.
@@ -240,11 +313,13 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
         with open(tmppath, 'wb') as outfile:
             outfile.write(data)
         if metadata.executable:
-            subprocess.run(['chmod', '+x', tmppath], check=True)
+            # Equivalent of 'chmod +x'; executable wherever readable.
+            mode = os.stat(tmppath).st_mode
+            os.chmod(tmppath, mode | (mode & 0o444) >> 2)
 
         # Ok; we wrote the file. Now move it into its final place.
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        subprocess.run(['mv', tmppath, path], check=True)
+        shutil.move(tmppath, path)
 
     if not os.path.exists(path):
         raise RuntimeError(f'File {path} did not wind up as expected.')
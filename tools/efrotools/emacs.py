@@ -33,9 +33,10 @@ def py_examine(
     """Given file position info, performs some code inspection."""
     # pylint: disable=too-many-locals
     # pylint: disable=cyclic-import
-    import astroid
     import re
-    from efrotools import code
+
+    # Note: editors fire these off frequently so we only import the
+    # (slow to import) analysis bits needed by the requested operation.
 
     # Pull in our pylint plugin which really just adds astroid filters.
     # That way our introspection here will see the same thing as pylint's does.
@@ -46,6 +47,8 @@ def py_examine(
     flines = fcontents.splitlines()
 
     if operation == 'pylint_infer':
+        import astroid
+
         # See what asteroid can infer about the target symbol.
         symbol = (
             selection
@@ -63,6 +66,8 @@ def py_examine(
         inferred = list(node.infer())
         print(symbol + ':', ', '.join([str(i) for i in inferred]))
     elif operation in ('mypy_infer', 'mypy_locals'):
+        from efrotools import code
+
         # Ask mypy for the type of the target symbol.
         symbol = (
             selection
@@ -92,10 +97,14 @@ def py_examine(
             print('error running mypy:', exc)
         tmppath.unlink()
     elif operation == 'pylint_node':
+        import astroid
+
         flines[line - 1] += ' #@'
         node = astroid.extract_node('\n'.join(flines))
         print(node)
     elif operation == 'pylint_tree':
+        import astroid
+
         flines[line - 1] += ' #@'
         node = astroid.extract_node('\n'.join(flines))
         print(node.repr_tree())
@@ -302,9 +302,11 @@ def run_client_pcommand(
 
 def disallow_in_batch() -> None:
     """Utility call to raise a clean error if running under batch mode."""
-    from efro.error import CleanError
-
     if _g_batch_server_mode:
+        # (only import this when we actually need it; nearly every
+        # pcommand calls us so the common path should stay light)
+        from efro.error import CleanError
+
         raise CleanError(
             'This pcommand does not support batch mode.\n'
             'See docs in efrotools.pcommand if you want to add it.'
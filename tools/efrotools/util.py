@@ -100,11 +100,9 @@ def get_files_hash(
         hashobj = getattr(hashlib, hashtype)()
     for fname in filenames:
         with open(fname, 'rb') as infile:
-            while True:
-                data = infile.read(2**20)
-                if not data:
-                    break
-                hashobj.update(data)
+            # Feeds our existing hash object via a single reused buffer
+            # instead of allocating a new bytes object per chunk.
+            hashlib.file_digest(infile, lambda: hashobj)
     hashobj.update(extrahash.encode())
 
     if int_only: